@@ -1,254 +1,341 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
+"""
+Mirror OSG repositories from the GOC via rsync.
+
+Repositories are synced concurrently, each with its own timeout and its own
+flock()-based lock.  Each sync goes into a fresh snapshot directory next to
+the live repository (copying unchanged files from the current snapshot
+rather than downloading them again), and the live path is a symlink that is
+swapped to the new snapshot with a single rename(), so clients never see a
+half-synced repository.  The previous snapshot is kept until the next sync,
+for clients still working from its metadata.
+
+Unchanged files are copied because AFS does not allow hardlinks between
+directories; elsewhere, --link-dest saves the space and time.
+
+For testing, --source-root can point at a local directory laid out like the
+GOC's, and --dest-root at a scratch directory.
+"""
+import argparse
+import errno
+import fcntl
 import logging
-import pwd
 import os
 from os.path import join as opj
-from socket import getfqdn
+import pwd
 import shutil
-import signal
 import subprocess
 import sys
-from time import clock, ctime, sleep, time
-
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from socket import getfqdn
 
 
 REPOS_ROOT = "/p/vdt/public/html/repos"
 #REPOS_ROOT = "/scratch/matyas/repos"
 GOC_ROOT = "rsync://repo.opensciencegrid.org/osg"
 #GOC_ROOT = "rsync://repo-itb.opensciencegrid.org/osg"
-LOCK_RETRY_MAX = 60 * 20
-GLOBAL_TIMEOUT = 60 * 119 # 2 hours
-
-DEBUG = False
-
-REPO_MAP = {}
-SYMLINK_MAP = {}
-vdtver = "3.0"
-for distro in ['el5', 'el6']:
-    for level in ['development', 'contrib', 'testing', 'release']:
-        key = "%(vdtver)s-%(distro)s-%(level)s" % locals()
-        from_loc = opj(GOC_ROOT, vdtver, distro, "osg-%s/" % level)
-        # For historical reasons, the dir for our release repos is
-        # called 'production'
-        if level == 'release':
-            locallevel = 'production'
-        else:
-            locallevel = level
-        to_loc = opj(REPOS_ROOT, vdtver, distro, locallevel)
-        REPO_MAP[key] = [from_loc, to_loc]
-        SYMLINK_MAP[key] = [os.path.basename(to_loc), opj(REPOS_ROOT, vdtver, distro, "osg-%s" % level)]
-
-class Alarm(Exception): pass
+REPO_TIMEOUT = 60 * 60  # 1 hour per repository
+RSYNC = "/usr/bin/rsync"
+LOCK_POLL_INTERVAL = 5
+JOBS = 4
+
+VDTVER = "3.0"
+DISTROS = ['el5', 'el6']
+LEVELS = ['development', 'contrib', 'testing', 'release']
+
+EXIT_TIMEOUT = 14
+
+
 class RsyncFailure(Exception): pass
+class Timeout(Exception): pass
 
-def alarm_handler(signum, frame):
-    if signum == signal.SIGALRM:
-        raise Alarm()
-    
 
-def safe_makedirs(directory, mode=0777):
+def make_repo_map(goc_root, repos_root):
+    """Return (REPO_MAP, SYMLINK_MAP) for the given source and destination
+    roots.  REPO_MAP maps a repo name to [rsync source, live path];
+    SYMLINK_MAP maps it to [symlink target, symlink path] for the GOC-style
+    alias of the live path.
+    """
+    repo_map = {}
+    symlink_map = {}
+    for distro in DISTROS:
+        for level in LEVELS:
+            key = "%s-%s-%s" % (VDTVER, distro, level)
+            from_loc = opj(goc_root, VDTVER, distro, "osg-%s/" % level)
+            # For historical reasons, the dir for our release repos is
+            # called 'production'
+            if level == 'release':
+                locallevel = 'production'
+            else:
+                locallevel = level
+            to_loc = opj(repos_root, VDTVER, distro, locallevel)
+            repo_map[key] = [from_loc, to_loc]
+            symlink_map[key] = [os.path.basename(to_loc),
+                                opj(repos_root, VDTVER, distro, "osg-%s" % level)]
+    return repo_map, symlink_map
+
+
+def safe_makedirs(directory, mode=0o777):
     """A wrapper around os.makedirs that does not raise an exception if the
     directory already exists.
-    
+
     """
     if not os.path.isdir(directory):
         os.makedirs(directory, mode)
 
 
-def obtain_lock(lock_file):
-    """Check for a lock on the repository, and obtain it if the repo is unlocked."""
-    #   Check for lockfile. Lockfiles should be in AFS and should contain the
-    # hostname, the uid, and the pid of the process.
+def obtain_lock(lock_file, deadline):
+    """Take an exclusive flock() on lock_file, waiting until `deadline` (a
+    time.time() value) at most.  Returns the open lock file; closing it
+    releases the lock.  The file contains user:host:pid of the holder, for
+    the benefit of humans.
+    """
     logging.debug("Obtaining lock %s", lock_file)
-    retry = 60
-    while retry < LOCK_RETRY_MAX and os.path.exists(lock_file):
-        #   If on local machine, see if that pid still exists. If not, continue.
-        fh = open(lock_file, 'r')
-        try:
-            line = fh.readline().strip()
-            try:
-                their_user, their_fqdn, their_pid = line.split(":")
-            except ValueError:
-                logging.warning("Unrecognized lockfile. Retrying in %d seconds." % retry)
-                sleep(retry)
-                retry *= 2
-                continue
-            if their_fqdn == getfqdn():
-                if os.path.exists(os.path.join("/proc", their_pid)):
-                    logging.info("Lockfile exists and owned by running "
-                                 "process. Retrying in %d seconds." % retry)
-                    sleep(retry)
-                    retry *= 2
-                    continue
-                else:
-                    logging.warning("Removing stale lockfile " + lock_file)
-                    os.unlink(lock_file)
-                    break
-            else:
-                logging.info("Lockfile exists and owned by process on "
-                             "remote machine. Retrying in %d seconds." % retry)
-                sleep(retry)
-                retry *= 2
-                continue
-        finally:
-            if fh:
-                fh.close()
-    if retry >= LOCK_RETRY_MAX:
-        if not their_user or not their_fqdn or not their_pid:
-            raise Exception("Lockfile " + lock_file + " exists but its contents"
-                            " are not recognized.")
-        else:
-            raise Exception("Lockfile " + lock_file + " exists.\n"
-                            "Lock created by " + their_user + " on " +
-                            their_fqdn + " with pid " + str(their_pid))
-    #   Create our lockfile.
     safe_makedirs(os.path.dirname(lock_file))
-    fh = open(lock_file, 'w')
+    fh = open(lock_file, 'a+')
     try:
-        lock_contents = ":".join([pwd.getpwuid(os.getuid())[0],
-                                  getfqdn(),
-                                  str(os.getpid())])
-        logging.debug("Lock contents: %s", lock_contents)
-        print >> fh, lock_contents
-    finally:
-        if fh:
-            fh.close()
+        while True:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError) as err:
+                if err.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                fh.seek(0)
+                raise Timeout("Lockfile %s is held by %s" %
+                              (lock_file, fh.readline().strip() or "unknown"))
+            time.sleep(min(LOCK_POLL_INTERVAL, remaining))
+        fh.seek(0)
+        fh.truncate()
+        fh.write(":".join([pwd.getpwuid(os.getuid())[0], getfqdn(),
+                           str(os.getpid())]) + "\n")
+        fh.flush()
+    except:
+        fh.close()
+        raise
+    return fh
 
 
-def release_lock(lock_file):
-    """Release the lock (if there is one)"""
-    logging.debug("Releasing lock %s", lock_file)
-    if os.path.exists(lock_file):
-        os.unlink(lock_file)
+def release_lock(lock_fh):
+    """Release a lock returned by obtain_lock()"""
+    logging.debug("Releasing lock %s", lock_fh.name)
+    lock_fh.truncate(0)
+    lock_fh.close()
 
 
-def do_mirror(goc_repo, live_repo, ip_repo, old_repo):
-    if os.path.exists(ip_repo):
-        shutil.rmtree(ip_repo)
+def current_snapshot(live_repo):
+    """Return the directory the live repo currently points to, or None"""
+    if os.path.islink(live_repo):
+        return os.path.realpath(live_repo)
+    elif os.path.isdir(live_repo):
+        return live_repo
+    return None
 
-    rsync_cmd = ["/usr/bin/rsync", "-arvt", goc_repo, "--exclude=debug/", ip_repo]
-    if os.path.exists(live_repo):
-        logging.debug("Live repo exists. Passing --copy-dest=%s to rsync", live_repo)
-        rsync_cmd += ["--copy-dest=" + live_repo]
 
-    rsync_outerr = ""
+def remove_stale_snapshots(live_repo, keep):
+    """Remove snapshot dirs of live_repo (including ones left behind by
+    interrupted runs) other than the ones in `keep`.  Must be called with the
+    lock held.
+    """
+    parent = os.path.dirname(live_repo)
+    prefix = ".%s." % os.path.basename(live_repo)
+    # compare resolved paths: keep may come from realpath() and any part of
+    # parent may be a symlink
+    keep = set(os.path.realpath(k) for k in keep if k)
+    for name in os.listdir(parent):
+        path = opj(parent, name)
+        if name.startswith(prefix) and os.path.realpath(path) not in keep \
+                and os.path.isdir(path) and not os.path.islink(path):
+            logging.debug("Removing old snapshot %s", path)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def publish(live_repo, snapshot):
+    """Atomically point the live_repo symlink at snapshot.  Returns where the
+    previously live repo is now, or None.
+    """
+    previous = current_snapshot(live_repo)
+    if os.path.isdir(live_repo) and not os.path.islink(live_repo):
+        # Repo from before snapshots were used; move it aside so that the
+        # symlink can take its place.  This is the only non-atomic step, and
+        # only happens once per repo.
+        legacy = opj(os.path.dirname(live_repo),
+                     ".%s.legacy" % os.path.basename(live_repo))
+        logging.info("Moving legacy repository %s to %s", live_repo, legacy)
+        os.rename(live_repo, legacy)
+        previous = legacy
+    tmp_link = opj(os.path.dirname(live_repo),
+                   ".symlink.%s.%d" % (os.path.basename(live_repo), os.getpid()))
+    if os.path.lexists(tmp_link):
+        os.unlink(tmp_link)
+    os.symlink(os.path.basename(snapshot), tmp_link)
+    os.rename(tmp_link, live_repo)
+    logging.debug("Published %s -> %s", live_repo, snapshot)
+    return previous
+
+
+def run_rsync(rsync_cmd, deadline):
+    """Run rsync, killing it at `deadline`.  Returns (returncode, output);
+    raises Timeout (with the output so far) if killed.
+    """
+    rsync_proc = subprocess.Popen(
+        rsync_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True)
     try:
-        rsync_proc = subprocess.Popen(
-            rsync_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-        # communicate() returns nothing if we kill the process via a signal,
-        # but we still want the output, so we're not using it.
-        while rsync_proc.poll() is None:
-            rsync_outerr += rsync_proc.stdout.readline()
-        rsync_ret = rsync_proc.returncode
-    except Alarm:
-        logging.critical("Global timeout exceeded")
-        logging.critical("Last rsync command: " + str(rsync_cmd))
-        logging.critical("rsync output follows:\n%s", rsync_outerr)
-        rsync_proc.send_signal(signal.SIGALRM)
-        raise
+        rsync_outerr, _ = rsync_proc.communicate(
+            timeout=max(0, deadline - time.time()))
+    except subprocess.TimeoutExpired:
+        rsync_proc.kill()
+        rsync_outerr, _ = rsync_proc.communicate()
+        raise Timeout("Timed out running %s; rsync output follows:\n%s" %
+                      (rsync_cmd, rsync_outerr))
+    return rsync_proc.returncode, rsync_outerr
+
+
+def do_mirror(goc_repo, live_repo, deadline, dry_run=False, dest_mode="copy"):
+    """Sync goc_repo into a new snapshot and publish it as live_repo.
+    Unchanged files are taken from the current snapshot with rsync's
+    --copy-dest or --link-dest, according to `dest_mode`.
+    Must be called with the lock held.
+    """
+    repo_parent = os.path.dirname(live_repo)
+    safe_makedirs(repo_parent)
+    old_snapshot = current_snapshot(live_repo)
+    if not dry_run:
+        # the one before old_snapshot has now been kept for a cycle
+        remove_stale_snapshots(live_repo, keep=[old_snapshot])
+
+    snapshot = tempfile.mkdtemp(prefix=".%s.%s." % (os.path.basename(live_repo),
+                                                     time.strftime("%Y%m%d-%H%M%S")),
+                                dir=repo_parent)
+    rsync_cmd = [RSYNC, "-arvt", goc_repo, "--exclude=debug/",
+                 snapshot + "/"]
+    if old_snapshot:
+        logging.debug("Live repo exists. Passing --%s-dest=%s to rsync",
+                      dest_mode, old_snapshot)
+        rsync_cmd += ["--%s-dest=%s" % (dest_mode, old_snapshot)]
+    if dry_run:
+        rsync_cmd += ["--dry-run"]
 
-    if rsync_ret:
-        logging.error("Last rsync command: " + str(rsync_cmd))
-        logging.error(rsync_outerr)
-        logging.error("Died with code %d", rsync_ret)
-        raise RsyncFailure("rsync had problems!")
-    else:
+    try:
+        rsync_ret, rsync_outerr = run_rsync(rsync_cmd, deadline)
+        if rsync_ret:
+            logging.error("Last rsync command: " + str(rsync_cmd))
+            logging.error(rsync_outerr)
+            logging.error("Died with code %d", rsync_ret)
+            raise RsyncFailure("rsync had problems!")
         logging.debug("rsync succeeded, output:\n%s", rsync_outerr)
+        if dry_run:
+            print(rsync_outerr)
+            shutil.rmtree(snapshot, ignore_errors=True)
+            return
+        previous = publish(live_repo, snapshot)
+    except:
+        shutil.rmtree(snapshot, ignore_errors=True)
+        raise
 
-    if os.path.exists(live_repo):
-        logging.debug("Saving live repository %s to %s", live_repo, old_repo)
-        shutil.move(live_repo, old_repo)
-
-    logging.debug("Making in-progress repository %s live", ip_repo)
-    shutil.move(ip_repo, live_repo)
-
-    if os.path.exists(old_repo):
-        logging.debug("Removing old repo %s", old_repo)
-        shutil.rmtree(old_repo)
+    # keep the previous snapshot, for clients that have its repomd.xml
+    remove_stale_snapshots(live_repo, keep=[snapshot, previous])
 
-    
 
-def make_symlink(repo):
+def make_symlink(symlink):
     # For historical reasons, our paths are different than the GOC's.
     # Make symlinks so that their paths work as well.
-    symlink = SYMLINK_MAP[repo]
-    if not os.path.exists(symlink[1]):
+    if not os.path.lexists(symlink[1]):
         logging.debug("Making symlink: %s -> %s" % (symlink[1], symlink[0]))
         os.symlink(symlink[0], symlink[1])
     else:
         logging.debug("Not making symlink: %s already exists" % symlink[1])
 
-    
-    
-
-#
-# SCRIPT BEGINS HERE
-#
-
-if DEBUG:
-    level = logging.DEBUG
-else:
-    level = logging.WARNING
-
-logging.basicConfig(format="%(levelname)s:" + os.path.basename(sys.argv[0]) + ":%(message)s",
-                    level=level)
-
-if len(sys.argv) < 2:
-    print >> sys.stderr, ("Usage: %s REPO..." % sys.argv[0])
-    print >> sys.stderr, ("Valid repositories are: ALL," +
-                          ",".join(REPO_MAP.keys()))
-    sys.exit(2)
-
-# validate arguments
-if 'ALL' not in sys.argv:
-    for a in sys.argv[1:]:
-        if a not in REPO_MAP:
-            print >> sys.stderr, ("%s is not a valid repository name. Valid "
-                                  "repositories are: ALL,%s" %
-                                  (a, ",".join(REPO_MAP.keys())))
-            sys.exit(2)
-    repos_to_sync = sys.argv[1:]
-else:
-    repos_to_sync = REPO_MAP.keys()
-
-logging.debug("Setting alarm for %d minutes", (GLOBAL_TIMEOUT / 60))
-signal.signal(signal.SIGALRM, alarm_handler)
-signal.alarm(GLOBAL_TIMEOUT)
-
-for repository in repos_to_sync:
-    goc_repo, live_repo = REPO_MAP[repository]
+
+def mirror_repo(repository, goc_repo, live_repo, symlink, timeout, dry_run=False,
+                dest_mode="copy"):
+    """Lock and mirror one repository.  Returns None on success, else an
+    exception instance.
+    """
+    deadline = time.time() + timeout
     logging.debug("*** Updating repository %s via rsync ***"
                   "\nfrom: %s\nto  : %s\n\n" %
                   (repository, goc_repo, live_repo))
-    repo_parent = os.path.dirname(live_repo)
-    repo_bn = os.path.basename(live_repo)
-    ip_repo = opj(repo_parent, ".in_progress." + repo_bn)
-    old_repo = opj(repo_parent, ".old." + repo_bn)
-    lock_file = opj(repo_parent, ".lock." + repo_bn)
-
-    if os.path.exists(old_repo):
-        logging.debug("Removing old repo %s", old_repo)
-        shutil.rmtree(old_repo)
-
-    obtain_lock(lock_file)
+    lock_file = opj(os.path.dirname(live_repo), ".lock." + os.path.basename(live_repo))
     try:
+        lock_fh = obtain_lock(lock_file, deadline)
         try:
-            start_time = time()
-            logging.debug("Started at " + ctime())
-            do_mirror(goc_repo, live_repo, ip_repo, old_repo)
-            make_symlink(repository)
-            end_time = time()
-            logging.debug("Finished at " + ctime())
-            elapsed_time = end_time - start_time
-            logging.debug("Elapsed time: %f seconds", elapsed_time)
+            start_time = time.time()
+            logging.debug("%s: started at %s", repository, time.ctime())
+            do_mirror(goc_repo, live_repo, deadline, dry_run, dest_mode)
+            if not dry_run:
+                make_symlink(symlink)
+            logging.debug("%s: elapsed time: %f seconds", repository,
+                          time.time() - start_time)
         finally:
-            release_lock(lock_file)
-    except Alarm:
-        sys.exit(14)
-    except RsyncFailure:
-        # in case of rsync failure, try the next repository instead of aborting
-        # everything
-        continue
+            release_lock(lock_fh)
+    except Timeout as err:
+        logging.critical("%s: %s", repository, err)
+        return err
+    except (RsyncFailure, EnvironmentError) as err:
+        # try the other repositories instead of aborting everything
+        logging.error("%s: %s", repository, err)
+        return err
+    return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("repos", metavar="REPO", nargs="+",
+                        help="Repositories to mirror, or ALL")
+    parser.add_argument("-j", "--jobs", type=int, default=JOBS,
+                        help="Number of repositories to sync at once (default %(default)s)")
+    parser.add_argument("-t", "--timeout", type=int, default=REPO_TIMEOUT,
+                        help="Seconds allowed per repository, including waiting "
+                             "for its lock (default %(default)s)")
+    parser.add_argument("--source-root", default=GOC_ROOT,
+                        help="rsync URL or local directory to mirror from (default %(default)s)")
+    parser.add_argument("--dest-root", default=REPOS_ROOT,
+                        help="Directory to mirror into (default %(default)s)")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="Only show what rsync would transfer; publish nothing")
+    parser.add_argument("--dest-mode", choices=["copy", "link"], default="copy",
+                        help="Take unchanged files from the current snapshot with "
+                             "rsync --copy-dest or --link-dest; 'link' saves space but "
+                             "only works where cross-directory hardlinks are allowed, "
+                             "which is not AFS (default %(default)s)")
+    parser.add_argument("-d", "--debug", action="store_true")
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(format="%(levelname)s:" + os.path.basename(argv[0]) + ":%(message)s",
+                        level=logging.DEBUG if args.debug else logging.WARNING)
+
+    repo_map, symlink_map = make_repo_map(args.source_root, args.dest_root)
+    # validate arguments
+    if 'ALL' in args.repos:
+        repos_to_sync = sorted(repo_map)
+    else:
+        for a in args.repos:
+            if a not in repo_map:
+                parser.error("%s is not a valid repository name. Valid "
+                             "repositories are: ALL,%s" % (a, ",".join(sorted(repo_map))))
+        repos_to_sync = args.repos
+
+    def mirror_one(repository):
+        goc_repo, live_repo = repo_map[repository]
+        return mirror_repo(repository, goc_repo, live_repo, symlink_map[repository],
+                           args.timeout, args.dry_run, args.dest_mode)
+
+    with ThreadPoolExecutor(max(1, args.jobs)) as pool:
+        errors = [e for e in pool.map(mirror_one, repos_to_sync) if e]
+
+    if any(isinstance(e, Timeout) for e in errors):
+        return EXIT_TIMEOUT
+    elif errors:
+        return 1
+    return 0
 
 
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
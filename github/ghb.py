@@ -1,11 +1,15 @@
 #!/usr/bin/python3
 
 # back up json for a github org's issues/comments/releases
+# (as one .json file per object, or with --shards, one sqlite db per repo)
 
 import os
 import sys
 import glob
 import json
+import zlib
+import sqlite3
+import argparse
 import datetime
 import operator
 
@@ -35,17 +39,158 @@ def mkdir_p(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
+class FileStore:
+    ''' one pretty-printed PATH.json file per object, and PATH.ts files '''
+
+    def name(self, relpath):
+        return relpath + '.json'
+
+    def load(self, relpath):
+        jsonpath = relpath + '.json'
+        if os.path.exists(jsonpath):
+            return json.load(open(jsonpath, "rt"))
+
+    def save(self, relpath, data):
+        mkdir_p(os.path.dirname(relpath))
+        print(to_json(data), file=open(relpath + '.json', "wt"))
+
+    def load_ts(self, path):
+        if os.path.exists(path):
+            return open(path, "rt").read().rstrip()
+
+    def save_ts(self, path, ts):
+        mkdir_p(os.path.dirname(path))
+        print(ts, file=open(path, 'wt'))
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+class ShardStore:
+    ''' objects and timestamps in one sqlite db per repo (REPO.sqlite next
+        to where REPO.json would be), keyed by the path of their .json/.ts
+        file, with zlib-compressed json; changes to a repo's shard are
+        committed together, once it's fully backed up '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS objects (path TEXT PRIMARY KEY,
+                                            collection TEXT, id TEXT,
+                                            data BLOB);
+        CREATE INDEX IF NOT EXISTS objects_collection
+                                   ON objects (collection, id);
+        CREATE TABLE IF NOT EXISTS timestamps (path TEXT PRIMARY KEY,
+                                               ts TEXT);
+    '''
+
+    MAX_OPEN = 16  # shards to keep open at once, eg, while importing
+
+    def __init__(self, root='.'):
+        self.root = root
+        self.dbs = {}
+
+    def shard(self, relpath):
+        key = '/'.join(relpath.split('/')[:3])  # eg, repos/ORG/REPO
+        if key not in self.dbs:
+            if len(self.dbs) >= self.MAX_OPEN:
+                self.close()
+            dbpath = os.path.join(self.root, key + '.sqlite')
+            mkdir_p(os.path.dirname(dbpath))
+            self.dbs[key] = sqlite3.connect(dbpath)
+            self.dbs[key].executescript(self.SCHEMA)
+        return key, self.dbs[key]
+
+    def name(self, relpath):
+        return "%s.sqlite:%s" % (self.shard(relpath)[0], relpath)
+
+    def load(self, relpath):
+        key, db = self.shard(relpath)
+        row = db.execute("SELECT data FROM objects WHERE path = ?",
+                         (relpath,)).fetchone()
+        if row:
+            return json.loads(zlib.decompress(row[0]).decode())
+
+    def save(self, relpath, data):
+        key, db = self.shard(relpath)
+        collection, _, id_ = relpath[len(key):].lstrip('/').rpartition('/')
+        blob = zlib.compress(json.dumps(data, sort_keys=True).encode())
+        db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+                   (relpath, collection, id_, blob))
+
+    def load_ts(self, path):
+        key, db = self.shard(path)
+        row = db.execute("SELECT ts FROM timestamps WHERE path = ?",
+                         (path,)).fetchone()
+        return row and row[0]
+
+    def save_ts(self, path, ts):
+        key, db = self.shard(path)
+        db.execute("INSERT OR REPLACE INTO timestamps VALUES (?, ?)", (path, ts))
+
+    def commit(self):
+        for db in self.dbs.values():
+            db.commit()
+
+    def close(self):
+        ''' commit and close the open shards '''
+        self.commit()
+        for db in self.dbs.values():
+            db.close()
+        self.dbs.clear()
+
+    def shards(self):
+        ''' the keys of all the shards under root '''
+        # include dot-named repos like ORG/.github, which "*" doesn't match
+        return [ os.path.relpath(dbpath, self.root)[:-len('.sqlite')] for pat
+                 in ("*/*/*.sqlite", "*/*/.*.sqlite") for dbpath
+                 in sorted(glob.glob(os.path.join(self.root, pat))) ]
+
+    def export(self, dest):
+        ''' write everything out under dest in the FileStore layout '''
+        files = FileStore()
+        nobjs = nts = 0
+        for key in self.shards():
+            key, db = self.shard(key)
+            for path, data in db.execute("SELECT path, data FROM objects"):
+                data = json.loads(zlib.decompress(data).decode())
+                files.save(os.path.join(dest, path), data)
+                nobjs += 1
+            for path, ts in db.execute("SELECT path, ts FROM timestamps"):
+                files.save_ts(os.path.join(dest, path), ts)
+                nts += 1
+            self.close()
+        print("exported %d objects and %d timestamps to %s" % (nobjs, nts, dest))
+
+    def import_files(self, src):
+        ''' load a FileStore layout under src into the shards '''
+        nobjs = nts = 0
+        for dirpath, dirnames, filenames in os.walk(src):
+            dirnames[:] = [ d for d in dirnames if d != '.git' ]
+            for fn in filenames:
+                path = os.path.relpath(os.path.join(dirpath, fn), src)
+                if path.count('/') < 2:
+                    continue  # not under repos/ORG/
+                if fn.endswith('.json'):
+                    data = json.load(open(os.path.join(src, path), "rt"))
+                    self.save(path[:-len('.json')], data)
+                    nobjs += 1
+                elif fn.endswith('.ts'):
+                    self.save_ts(path, open(os.path.join(src, path), "rt").read().rstrip())
+                    nts += 1
+        self.close()
+        print("imported %d objects and %d timestamps from %s" % (nobjs, nts, src))
+
+store = FileStore()
+
 def dump_obj(obj):
     relpath = rel_url_path(obj.url)
-    mkdir_p(os.path.dirname(relpath))
-    jsonpath = relpath + '.json'
-    if os.path.exists(jsonpath):
-        if json.load(open(jsonpath, "rt")) == obj._rawData:
-            print("skipping already-up-to-date %s" % jsonpath)
-            return
-    print("writing %s" % jsonpath)
-    json_data = to_json(obj._rawData)  # .raw_data triggers reload
-    print(json_data, file=open(jsonpath, "wt"))
+    name = store.name(relpath)
+    if store.load(relpath) == obj._rawData:
+        print("skipping already-up-to-date %s" % name)
+        return
+    print("writing %s" % name)
+    store.save(relpath, obj._rawData)  # .raw_data triggers reload
     return True
 
 def dump_org_repos(org):
@@ -63,6 +208,7 @@ def dump_repo(repo):
     dump_updated_obj_items(repo, "issues_comments")
     dump_updated_obj_items(repo, "pulls_comments")
     dump_updated_obj_items(repo, "releases")
+    store.close()  # one repo's shard open at a time
 
 def dump_updated_obj_items(obj, gettername, nest=None, **igkw):
     updated_at_path = "%s/%s.ts" % (rel_url_path(obj.url), gettername)
@@ -79,11 +225,11 @@ def dump_items(items, updated_at_path=None, nest=None, want_since=False):
         for item in updated_items:
             dump_updated_obj_items(item, nest)
     if want_since and (updated_items or
-                       (items and not os.path.exists(updated_at_path))):
+                       (items and store.load_ts(updated_at_path) is None)):
         if hasattr(items[0], 'updated_at'):
             last_update = max( i.updated_at for i in items )
             print("writing %s" % updated_at_path)
-            print(datetime_to_raw(last_update), file=open(updated_at_path, 'wt'))
+            store.save_ts(updated_at_path, datetime_to_raw(last_update))
     elif updated_at_path:
         print("no new items for %s" % updated_at_path.replace('.ts', ''))
     return updated_items
@@ -94,24 +240,48 @@ def accepts_since(f):
     return 'since' in argnames
 
 def get_since_kw(path, itemgetter, want_since):
-    if want_since and os.path.exists(path):
-        last = raw_to_datetime(open(path, "rt").read().rstrip())
+    ts = want_since and store.load_ts(path)
+    if ts:
+        last = raw_to_datetime(ts)
         since = last + datetime.timedelta(0, 1)
         return {'since': since}
     else:
         return {}
 
 def main(argv):
-    if len(argv) == 2 and os.path.exists(argv[1]):
-        org = argv[0]
-        user_token = [ l.rstrip() for l in open(argv[1], "rt") ]
+    global store
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [--shards] ORG USER_TOKEN_FILE\n"
+              "       %(prog)s --export DEST_DIR\n"
+              "       %(prog)s --import SRC_DIR")
+    parser.add_argument('org', nargs='?', help=argparse.SUPPRESS)
+    parser.add_argument('token_file', nargs='?', help=argparse.SUPPRESS)
+    parser.add_argument('--shards', action='store_true',
+                        help="keep objects in a compressed sqlite shard per "
+                             "repo, instead of one .json file per object")
+    parser.add_argument('--export', metavar='DEST_DIR',
+                        help="write the shards out as .json/.ts files under "
+                             "DEST_DIR")
+    parser.add_argument('--import', dest='import_dir', metavar='SRC_DIR',
+                        help="load the .json/.ts files under SRC_DIR into "
+                             "shards")
+    args = parser.parse_args(argv)
+
+    if args.export:
+        ShardStore().export(args.export)
+    elif args.import_dir:
+        ShardStore().import_files(args.import_dir)
+    elif args.token_file and os.path.exists(args.token_file):
+        if args.shards:
+            store = ShardStore()
+        user_token = [ l.rstrip() for l in open(args.token_file, "rt") ]
         g = github.Github(*user_token, timeout=60)
         print("rate_limiting api queries remaining: %s/%s" % g.rate_limiting)
         print("---")
-        o = g.get_organization(org)
+        o = g.get_organization(args.org)
         dump_org_repos(o)
     else:
-        print("usage: %s ORG USER_TOKEN_FILE" % os.path.basename(__file__))
+        parser.print_usage()
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -1,5 +1,10 @@
+import bisect
+import cPickle as pickle
 import datetime
+import hashlib
+import tempfile
 import urllib
+import urllib2
 import re
 import os
 import sys
@@ -36,32 +41,208 @@ class CalEvent:
             raise TypeError("date should be a datetime.date")
         return (date >= self.start_date and date <= self.end_date)
         
+def _unfold(lines):
+    """Yields the logical lines of an ical file, with the line endings
+    removed and folded (continuation) lines joined back together
+    (RFC 5545 section 3.1)
+    """
+    logical = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and logical is not None:
+            logical += line[1:]
+            continue
+        if logical is not None:
+            yield logical
+        logical = line
+    if logical is not None:
+        yield logical
+
+
+def _split_property(line):
+    """Splits a content line into (name, value), dropping any parameters
+    (e.g. "DTSTART;TZID=America/Chicago:20120408T090000"); ':' and ';' are
+    allowed inside quoted parameter values
+    """
+    colon = line.find(":")
+    if colon >= 0 and '"' not in line[:colon]:
+        semi = line.find(";", 0, colon)
+        return line[:colon if semi < 0 else semi].upper(), line[colon+1:]
+    in_quote = False
+    name_end = None
+    for i, c in enumerate(line):
+        if c == '"':
+            in_quote = not in_quote
+        elif in_quote:
+            continue
+        elif c == ";" and name_end is None:
+            name_end = i
+        elif c == ":":
+            if name_end is None:
+                name_end = i
+            return line[:name_end].upper(), line[i+1:]
+    return line.upper(), ""
+
+
+def _parse_date(value):
+    """Returns the datetime.date for a DATE or DATE-TIME value"""
+    return datetime.date(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+
+
+_TEXT_ESCAPES = {"n": "\n", "N": "\n", ",": ",", ";": ";", "\\": "\\"}
+
+
+def _unescape_text(value):
+    return re.sub(r"\\(.)", lambda m: _TEXT_ESCAPES.get(m.group(1), m.group(0)),
+                  value)
+
+
+# property name -> (key in the event being built, function to decode value)
+_EVENT_PROPERTIES = {
+    "DTSTART": ("start_date", _parse_date),
+    "DTEND":   ("end_date", _parse_date),
+    "SUMMARY": ("summary", _unescape_text),
+}
+
+
+def iter_ical_events(lines):
+    """Generator yielding a CalEvent for each VEVENT in an ical file (or
+    any other iterable of its lines), in a single pass.  Properties of
+    components nested within a VEVENT (e.g. VALARM) are ignored.  DTEND
+    is taken to be the (inclusive) last day of the event; if it is
+    missing, the event is a single day.
+    """
+    components = []
+    event = None
+    for line in _unfold(lines):
+        name, value = _split_property(line)
+        if name == "BEGIN":
+            components.append(value.upper())
+            if components == ["VCALENDAR", "VEVENT"] or components == ["VEVENT"]:
+                event = {}
+        elif name == "END":
+            if components and components.pop() == "VEVENT" and event is not None:
+                if "start_date" in event:
+                    yield CalEvent(event.get("summary", ""),
+                                   event["start_date"], event.get("end_date"))
+                event = None
+        elif event is not None and components[-1] == "VEVENT":
+            prop = _EVENT_PROPERTIES.get(name)
+            if prop is not None:
+                key, decode = prop
+                event[key] = decode(value)
+
+
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.cache/iCalLib")
+
+
+def _read_cache_meta(meta_path):
+    """Returns a dict of the headers saved in a cache .meta file"""
+    meta = {}
+    if os.path.exists(meta_path):
+        meta_fh = open(meta_path, "r")
+        for line in meta_fh:
+            name, _, value = line.rstrip("\n").partition(": ")
+            meta[name] = value
+        meta_fh.close()
+    return meta
+
+
+def _write_cache_file(path, data):
+    """Atomically replaces the file at path with data"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        tmp_fh = os.fdopen(fd, "wb")
+        tmp_fh.write(data)
+        tmp_fh.close()
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
 class Cal:
     def __init__(self):
         """This is the constructor for the Cal class, there are no 
         parameters.
         """
         self.events = []
+        self._index = None
         
         
-    def download(self, url):
+    def download(self, url, cache_dir=DEFAULT_CACHE_DIR):
         """This method downloads an ical file (it makes sure you are in  
-        fact downloading an ical file) from a given url to
-        whatever directory this script is in and names it "ical.ics"
+        fact downloading an ical file) from a given url and parses it.
+
+        The raw file and the parsed events are kept in cache_dir (pass
+        None to disable caching); on later calls the server is asked
+        whether the file changed (ETag/If-Modified-Since), and if not,
+        the cached events are loaded instead of re-downloading and
+        re-parsing the calendar.
         """
         if not re.search("\.ics$", url):
             raise ValueError("url must be link to .ics file")
-        
+
+        if cache_dir is None:
+            try:
+                icfile = urllib.urlretrieve(url)
+                print "Downloaded calendar successfully"
+            except IOError:
+                print "Downloaded unsuccessful"
+                raise
+            self.parse_for_events(icfile[0])
+            return
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        base = os.path.join(cache_dir, hashlib.sha1(url).hexdigest())
+        ics_path, meta_path, events_path = \
+            base + ".ics", base + ".meta", base + ".events"
+
+        request = urllib2.Request(url)
+        meta = _read_cache_meta(meta_path)
+        if os.path.exists(ics_path) and os.path.exists(events_path):
+            if meta.get("ETag"):
+                request.add_header("If-None-Match", meta["ETag"])
+            if meta.get("Last-Modified"):
+                request.add_header("If-Modified-Since", meta["Last-Modified"])
         try:
-            icfile = urllib.urlretrieve(url)
-            print "Downloaded calendar successfully"
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, err:
+            if err.code != 304:
+                print "Downloaded unsuccessful"
+                raise
+            events_fh = open(events_path, "rb")
+            try:
+                for summary, start_date, end_date in pickle.load(events_fh):
+                    self.add_event(CalEvent(summary, start_date, end_date))
+            finally:
+                events_fh.close()
+            print "Calendar not modified; using cached copy"
+            return
         except IOError:
             print "Downloaded unsuccessful"
             raise
-        ical_file = icfile[0]
-            
-        self.parse_for_events(ical_file)
-        
+
+        # the old validators no longer describe what is cached
+        if os.path.exists(meta_path):
+            os.unlink(meta_path)
+        try:
+            _write_cache_file(ics_path, response.read())
+        finally:
+            response.close()
+        print "Downloaded calendar successfully"
+
+        num_events = len(self.events)
+        self.parse_for_events(ics_path)
+        _write_cache_file(events_path, pickle.dumps(
+            [(e.summary, e.start_date, e.end_date)
+             for e in self.events[num_events:]], pickle.HIGHEST_PROTOCOL))
+        headers = response.info()
+        _write_cache_file(meta_path, "".join(
+            "%s: %s\n" % (name, headers[name])
+            for name in ("ETag", "Last-Modified") if headers.get(name)))
+
     def add_event(self,event):
         """Adds contents of a CalEvent (event) passed as a parameter"""
         
@@ -69,56 +250,69 @@ class Cal:
             raise TypeError("event should be a CalEvent")
         
         self.events.append(event)
+        self._index = None
         
     def parse_for_events(self, ical_file):
         """Parses the ical file for events"""
-        start_date = None
-        end_date = None
-        summary = None
-        in_event = False
-
         ical_fh = open(ical_file, "r")
-        for line in ical_fh:
-            
-            if re.search('BEGIN:VEVENT',line):
-                in_event = True
-                continue
-            elif re.search('END:VEVENT',line):
-                in_event = False
-                continue
+        try:
+            for event in iter_ical_events(ical_fh):
+                self.add_event(event)
+        finally:
+            ical_fh.close()
 
-            if in_event:
-                if re.search('DTSTART',line):
-                    value_match = re.search(r':(\d+)',line)
-                    start_date = value_match.group(1)
-                if re.search('DTEND',line):
-                    value_match = re.search(r':(\d+)',line)
-                    end_date = value_match.group(1)
-                if re.search('SUMMARY',line):
-                    value_match = re.search(r':(.+)',line)
-                    summary = value_match.group(1)
-                
-            if start_date is not None and end_date is not None and summary is not None:
-                start_date_year = int(start_date[0:4])
-                start_date_month = int(start_date[4:6])
-                start_date_day = int(start_date[6:8])
-                start_date_obj = datetime.date(start_date_year, start_date_month, start_date_day)
-                end_date_year = int(end_date[0:4])
-                end_date_month = int(end_date[4:6])
-                end_date_day = int(end_date[6:8])
-                end_date_obj = datetime.date(end_date_year, end_date_month, end_date_day)
-                self.add_event(CalEvent(summary, start_date_obj, end_date_obj))
-                start_date = None
-                end_date = None
-                summary = None
-                
+    def _build_index(self):
+        """Builds the interval index used by events_between: the events
+        sorted by start date, and a binary tree (stored in an array, with
+        the events as its leaves) of the latest end date in each subtree.
+        """
+        events = sorted(self.events, key=lambda e: (e.start_date, e.end_date))
+        size = 1
+        while size < len(events):
+            size *= 2
+        max_end = [None] * (2 * size)
+        for i, event in enumerate(events):
+            max_end[size + i] = event.end_date
+        for i in range(size - 1, 0, -1):
+            left, right = max_end[2 * i], max_end[2 * i + 1]
+            max_end[i] = left if right is None or (left is not None and
+                                                   left > right) else right
+        starts = [e.start_date for e in events]
+        self._index = (events, starts, max_end, size, len(self.events))
+
+    def events_between(self, start, end):
+        """Return a list of events occurring on any day from start to end
+        (datetime.dates, inclusive), ordered by start date.
+        """
+        if not isinstance(start, datetime.date) or \
+                not isinstance(end, datetime.date):
+            raise TypeError("start and end should be datetime.dates")
+        if self._index is None or self._index[4] != len(self.events):
+            self._build_index()
+        events, starts, max_end, size, _ = self._index
+
+        # only events starting by 'end' can match; of those, descend only
+        # into subtrees containing an event that ends on or after 'start'
+        hi = bisect.bisect_right(starts, end)
+        ret = []
+        stack = [(1, 0, size)]
+        while stack:
+            node, lo, node_hi = stack.pop()
+            if lo >= hi or max_end[node] is None or max_end[node] < start:
+                continue
+            if node >= size:
+                ret.append(events[lo])
+            else:
+                mid = (lo + node_hi) // 2
+                stack.append((2 * node + 1, mid, node_hi))
+                stack.append((2 * node, lo, mid))
+        return ret
 
     def events_on_date(self,date):
         """Return events on a given datetime.date in a list"""
-        ret = []
-        for event in self.events:
-            if event.occurs_on_day(date):
-                ret.append(event)
+        if not isinstance(date, datetime.date):
+            raise TypeError("date should be a datetime.date")
+        ret = self.events_between(date, date)
         if not ret:
             # if list is empty
             print "no events found for that date"
@@ -6,6 +6,7 @@ import json
 import sys
 import re
 import os
+from collections import deque
 
 
 # python2/3 compat unicode handling
@@ -16,7 +17,8 @@ if str is _unicode:
         return obj
 
     def uopen(path, *a):
-        return open(path, *a, encoding='utf-8')
+        # newline='': leaves must keep any '\r' / '\r\n' in their values
+        return open(path, *a, encoding='utf-8', newline='')
 else:
     def udec(obj):
         if isinstance(obj, _unicode):
@@ -28,6 +30,16 @@ else:
         _open = os.fdopen if isinstance(path, int) else open
         return _open(path, *a)
 
+try:
+    from os import scandir as _scandir
+except ImportError:  # python2
+    _scandir = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor  # py3 or 'futures'
+except ImportError:
+    ThreadPoolExecutor = None
+
 
 def do_subdir(name, items):
         os.mkdir(name)
@@ -47,28 +59,337 @@ def write_json_fs_obj(obj, name):
             print(udec(obj), file=w)
 
 
+# incremental (event-based) parsing, for documents too big to load at once
+
+_STREAM_CHUNK = 1 << 16
+_WS = ' \t\r\n'
+_DELIMS = _WS + ',:]}'
+
+
+class _JSONEventReader(object):
+    """Tokenize a JSON document from file object 'fh', yielding events:
+
+        ('start_map', None), ('map_key', key), ('end_map', None),
+        ('start_array', None), ('end_array', None), ('value', scalar)
+
+    Only the current chunk (plus any single scalar spanning chunks) is kept
+    in memory, so memory use does not grow with the size of the document.
+    """
+
+    def __init__(self, fh, chunksize=_STREAM_CHUNK):
+        self.fh = fh
+        self.chunksize = chunksize
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.fh.read(self.chunksize)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        # return next non-whitespace char, or None at EOF
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WS:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return None
+
+    def _expect(self, chars):
+        c = self._peek()
+        if c is None or c not in chars:
+            self._error("expected one of %r" % chars)
+        self.pos += 1
+        return c
+
+    def _scalar(self):
+        if self.buf[self.pos] != '"':
+            # a number or literal may continue in the next chunk; make sure
+            # its terminating delimiter (or EOF) is in the buffer first
+            scanned = 0
+            while True:
+                tail = self.buf[self.pos + scanned:]
+                if any(c in _DELIMS for c in tail):
+                    break
+                scanned += len(tail)
+                if not self._fill():
+                    break
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # possibly a string continuing in the next chunk
+                if not self._fill():
+                    self._error("invalid value")
+                continue
+            self.pos = end
+            return obj
+
+    def _error(self, msg):
+        raise ValueError("%s at offset %d of current buffer: %r"
+                         % (msg, self.pos, self.buf[self.pos:self.pos+20]))
+
+    def _value_events(self, c):
+        # events for a value starting with char 'c'; containers are
+        # opened here and closed by the main loop in events()
+        if c == '{':
+            self.pos += 1
+            return ('start_map', None), '}'
+        elif c == '[':
+            self.pos += 1
+            return ('start_array', None), ']'
+        else:
+            return ('value', self._scalar()), None
+
+    def events(self):
+        c = self._peek()
+        if c is None:
+            self._error("empty document")
+        ev, close = self._value_events(c)
+        yield ev
+        stack = [close] if close else []
+        first = True
+        while stack:
+            c = self._peek()
+            if c == stack[-1]:
+                self.pos += 1
+                yield ('end_map' if stack.pop() == '}' else 'end_array'), None
+                first = False
+                continue
+            if not first:
+                self._expect(',')
+            if stack[-1] == '}':
+                if self._peek() != '"':
+                    self._error("expected object key")
+                yield 'map_key', self._scalar()
+                self._expect(':')
+            c = self._peek()
+            if c is None:
+                self._error("unexpected end of document")
+            ev, close = self._value_events(c)
+            yield ev
+            if close:
+                stack.append(close)
+                first = True
+            else:
+                first = False
+        if self._peek() is not None:
+            self._error("trailing data")
+
+
+def write_json_fs_events(events, name):
+    """Like write_json_fs_obj, but driven by parser events; directories are
+    created and leaves written as soon as they are encountered.
+    """
+    stack = []  # per open container: next list index, or None for a dict
+    key = name
+    for ev, val in events:
+        if ev == 'map_key':
+            key = str(val)
+            continue
+        if stack and stack[-1] is not None:
+            key = str(stack[-1])
+            stack[-1] += 1
+        if ev in ('start_map', 'start_array'):
+            os.mkdir(key)
+            os.chdir(key)
+            stack.append(0 if ev == 'start_array' else None)
+        elif ev in ('end_map', 'end_array'):
+            # the index bump above was for a non-existent next item
+            stack.pop()
+            os.chdir("..")
+        else:
+            write_json_fs_obj(val, key)
+
+
+# reverse mode: rebuild a json document from a tree made by json2fs
+
+_FS2JSON_WORKERS = 16
+
+
+def decode_leaf(text):
+    """Invert write_json_fs_obj for a leaf: non-string values were written
+    with str(), so map text that is exactly what str() would have produced
+    for a bool, null, int or float back to that type; anything else is a
+    string.
+    """
+    if text.endswith('\n'):
+        text = text[:-1]
+    if text in _LEAF_LITERALS:
+        return _LEAF_LITERALS[text]
+    if re.match(r'-?\d+$', text) and str(int(text)) == text:
+        return int(text)
+    try:
+        f = float(text)
+    except ValueError:
+        return text
+    return f if str(f) == text else text
+
+_LEAF_LITERALS = {'True': True, 'False': False, 'None': None}
+
+
+def read_leaf(path):
+    with uopen(path) as r:
+        return decode_leaf(r.read())
+
+
+def _list_names(names):
+    # a dir whose entries are exactly 0..N-1 came from a list via enumerate
+    if names and set(names) == set(str(i) for i in range(len(names))):
+        return sorted(names, key=int), True
+    return sorted(names), False
+
+
+def _dir_entries(path):
+    # {name: (path, is_dir)} for the entries of directory 'path'
+    if _scandir is not None:
+        return dict((e.name, (e.path, e.is_dir())) for e in _scandir(path))
+    entries = {}
+    for name in os.listdir(path):
+        subpath = os.path.join(path, name)
+        entries[name] = (subpath, os.path.isdir(subpath))
+    return entries
+
+
+def fs_events(path, submit):
+    """Walk the tree at 'path', yielding the same events as
+    _JSONEventReader.events(), but with leaf values as futures from
+    submit(read_leaf, leafpath), so leaves can be read concurrently.
+    """
+    if not os.path.isdir(path):
+        yield 'value', submit(read_leaf, path)
+        return
+    entries = _dir_entries(path)
+    names, is_list = _list_names(list(entries))
+    yield ('start_array' if is_list else 'start_map'), None
+    for name in names:
+        if not is_list:
+            yield 'map_key', name
+        subpath, is_dir = entries[name]
+        if is_dir:
+            for ev in fs_events(subpath, submit):
+                yield ev
+        else:
+            yield 'value', submit(read_leaf, subpath)
+    yield ('end_array' if is_list else 'end_map'), None
+
+
+def resolve_events(events, window):
+    """Pass events through in order, replacing leaf futures with their
+    results; up to 'window' events are kept pending, so that many leaf
+    reads can be in flight at once without holding the whole tree.
+    """
+    pending = deque()
+    for ev in events:
+        pending.append(ev)
+        if len(pending) > window:
+            ev, val = pending.popleft()
+            yield ev, (val.result() if ev == 'value' else val)
+    while pending:
+        ev, val = pending.popleft()
+        yield ev, (val.result() if ev == 'value' else val)
+
+
+def write_json_events(events, out):
+    """Serialize parser events as json text to file object 'out'"""
+    need_comma = [False]
+    for ev, val in events:
+        if ev in ('end_map', 'end_array'):
+            need_comma.pop()
+            out.write('}' if ev == 'end_map' else ']')
+            continue
+        if need_comma[-1]:
+            out.write(',')
+        if ev == 'map_key':
+            out.write(json.dumps(val) + ':')
+            need_comma[-1] = False
+            continue
+        need_comma[-1] = True
+        if ev == 'value':
+            out.write(json.dumps(val))
+        else:
+            out.write('{' if ev == 'start_map' else '[')
+            need_comma.append(False)
+    out.write('\n')
+
+
+class _Done(object):
+    # stands in for a future when leaves are read serially
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+def _read_now(fn, *a):
+    return _Done(fn(*a))
+
+
+def fs2json(path, out, workers=_FS2JSON_WORKERS):
+    if ThreadPoolExecutor is None:
+        # no concurrent.futures (python2 without 'futures'): read serially
+        write_json_events(resolve_events(fs_events(path, _read_now), 0), out)
+        return
+    with ThreadPoolExecutor(workers) as pool:
+        events = fs_events(path, pool.submit)
+        write_json_events(resolve_events(events, workers * 4), out)
+
+
 def default_dest(path):
     return 'stdin%' if path == '-' else path + '%'
 
 
 def main(args):
+    stream = reverse = False
+    if args and args[0] in ('-s', '--stream'):
+        stream = True
+        args = args[1:]
+    elif args and args[0] in ('-r', '--fs2json'):
+        reverse = True
+        args = args[1:]
     if not 1 <= len(args) <= 2 or re.match(r'-.', args[0]):
         usage()
+    if reverse:
+        dest = args[1] if len(args) == 2 and args[1] != '-' else 1
+        with uopen(dest, "w") as out:
+            fs2json(args[0], out)
+        return
     path, dest = (args + [default_dest(args[0])])[:2]
     if path == '-':
         path = 0  # '-' for stdin -> fd 0
-    write_json_fs_obj(json.load(uopen(path)), dest)
+    if stream:
+        write_json_fs_events(_JSONEventReader(uopen(path)).events(), dest)
+    else:
+        write_json_fs_obj(json.load(uopen(path)), dest)
 
 
 def usage():
     s = os.path.basename(__file__)
-    print("Usage: {script} file.json [dest]".format(script=s))
+    print("Usage: {script} [-s|--stream] file.json [dest]".format(script=s))
+    print("       {script} -r|--fs2json path [dest.json]".format(script=s))
     print()
     print("Expands contents of json file to new path 'dest'.")
     print("If 'file.json' is '-', read from stdin.")
     print()
     print("If 'dest' path is omitted, 'file.json%'")
     print()
+    print("With -s/--stream, parse incrementally instead of loading the")
+    print("whole document first; memory use is bounded by nesting depth.")
+    print()
+    print("With -r/--fs2json, rebuild json from a tree made by this script,")
+    print("writing to 'dest.json' (or stdout if omitted or '-').")
+    print("Dirs named 0..N-1 become lists, other dirs (incl. empty) objects;")
+    print("leaves that look exactly like a bool, null or number become one.")
+    print()
     sys.exit(0)
 
 
@@ -6,19 +6,27 @@ the latest, and check out the given BRANCH.
 
 If DIRECTORY does not exist, REPO is cloned instead.
 
+With --manifest, update every repo listed in a manifest file instead,
+several at a time, and send one notification for the whole run.  Each
+non-blank, non-comment line of the manifest is "REPO DIRECTORY [BRANCH]".
+
 """
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 import logging
 import logging.handlers
 import pwd
 import os
 import shlex
+import signal
 import smtplib
 import socket
 import subprocess
 import sys
+import threading
+import time
 
 from io import StringIO
 
@@ -41,7 +49,34 @@ def send_email(recipients, subject, text):
     smtp.quit()
 
 
-def run_git_command(command, directory=None, git_directory=None):
+def run_with_timeout(full_command, timeout, stderr=subprocess.STDOUT):
+    """Run `full_command` and return (returncode, stdout, stderr).
+
+    The command gets its own process group, which is killed as a whole if
+    `timeout` expires; killing only git would leave its transport (ssh or a
+    remote helper) running and holding the output pipe open.  Raises
+    subprocess.TimeoutExpired in that case, without waiting for the pipes.
+
+    """
+    proc = subprocess.Popen(
+        full_command, stdout=subprocess.PIPE, stderr=stderr, start_new_session=True
+    )
+    try:
+        out, err = proc.communicate(timeout=timeout)
+    except BaseException:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        for pipe in (proc.stdout, proc.stderr):
+            if pipe:
+                pipe.close()
+        proc.wait()
+        raise
+    return proc.returncode, out, err
+
+
+def run_git_command(command, directory=None, git_directory=None, timeout=None):
     """Run an arbitrary git command, optionally specifying the git directory
     For a bare git repo, specify `git_directory` but not `directory`.
 
@@ -49,6 +84,7 @@ def run_git_command(command, directory=None, git_directory=None):
         command (list of str) The git command to run
         directory (str)       path to git work-tree, if not current directory
         git_directory (str)   path to git-dir, if not .git subdirectory of work-tree
+        timeout (float)       seconds after which to kill the command and fail
 
     Returns:
         bool: True if successful, False otherwise
@@ -64,14 +100,20 @@ def run_git_command(command, directory=None, git_directory=None):
 
     full_command = base_command + command
 
-    git_proc = subprocess.Popen(
-        full_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-    )
-    out = git_proc.communicate()[0].decode().strip()
+    command_str = " ".join(shlex.quote(x) for x in full_command)
+    if timeout is not None and timeout <= 0:
+        log.error("%s... NOT RUN  out of time\n", command_str)
+        return False
+
+    try:
+        returncode, out, _ = run_with_timeout(full_command, timeout)
+    except subprocess.TimeoutExpired:
+        log.error("%s... TIMED OUT  after %.0f seconds\n", command_str, timeout)
+        return False
+    out = out.decode().strip()
     outstr = "output:\n%s\n\n" % out if out else "no output\n"
 
-    command_str = " ".join(shlex.quote(x) for x in full_command)
-    if git_proc.returncode != 0:
+    if returncode != 0:
         log.error("%s... FAILED  %s", command_str, outstr)
         return False
 
@@ -79,15 +121,64 @@ def run_git_command(command, directory=None, git_directory=None):
     return True
 
 
-def git_clone_or_pull(repo, directory, branch):
+def get_git_output(command, directory=None, timeout=None):
+    """Run a git command in the work-tree `directory` and return its output,
+    or None if it fails.  Errors are only logged at debug level; callers
+    are expected to fall back to doing things the slow way.
+
+    """
+    full_command = ["git"]
+    if directory:
+        full_command += ["--git-dir", os.path.join(directory, ".git")]
+    full_command += command
+    command_str = " ".join(shlex.quote(x) for x in full_command)
+    try:
+        returncode, out, err = run_with_timeout(full_command, timeout, subprocess.PIPE)
+    except (OSError, ValueError, subprocess.TimeoutExpired) as e:
+        log.debug("%s... FAILED  %s\n", command_str, e)
+        return None
+    if returncode != 0:
+        log.debug("%s... FAILED  %s\n", command_str, err.decode().strip())
+        return None
+    return out.decode().strip()
+
+
+def get_remote_branch_sha(directory, branch, timeout=None):
+    """Return the sha of `branch` on the `origin` remote of the repo in
+    `directory` according to `git ls-remote` (parsed the same way as in
+    github/git-remote-ref-sha, but only asking for the one ref), or None.
+
+    """
+    ref = "refs/heads/%s" % branch
+    output = get_git_output(["ls-remote", "origin", ref], directory, timeout)
+    for line in (output or "").splitlines():
+        sha, _, refname = line.partition("\t")
+        if refname == ref:
+            return sha
+    return None
+
+
+def git_clone_or_pull(
+    repo, directory, branch, timeout=None, clone_args=(), always_update=False
+):
     """Clone a git repository from `repo` into `directory`, or, if a git
     repository already exists, update to the latest changes from `origin`.
-    Then, check out `branch`
+    Then, check out `branch`.  If `timeout` is given, fail if that takes
+    more than `timeout` seconds in total.
+
+    For an existing repo, nothing is done if `origin`'s `branch` is already
+    checked out, unless `always_update` is set.  `clone_args` are extra
+    arguments for the initial clone (e.g. for a shallow or partial clone).
 
     Returns:
         bool: True if all operations succeeded, False otherwise
 
     """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def remaining():
+        return None if deadline is None else deadline - time.monotonic()
+
     if not os.path.exists(directory):
         log.info(
             "Making initial repo clone from %s to %s; using branch %s\n",
@@ -95,20 +186,33 @@ def git_clone_or_pull(repo, directory, branch):
             directory,
             branch,
         )
-        ok = run_git_command(["clone", repo, directory])
-        ok = ok and run_git_command(["checkout", branch], directory=directory)
+        ok = run_git_command(
+            ["clone"] + list(clone_args) + [repo, directory], timeout=remaining()
+        )
+        ok = ok and run_git_command(
+            ["checkout", branch], directory=directory, timeout=remaining()
+        )
         return ok
 
     if os.path.exists(os.path.join(directory, ".git")):
+        if not always_update:
+            # cheap check first: cleaning and resetting touch every file
+            remote_sha = get_remote_branch_sha(directory, branch, remaining())
+            local_sha = get_git_output(["rev-parse", "HEAD"], directory, remaining())
+            if remote_sha and remote_sha == local_sha:
+                log.info("%s is already at origin/%s (%s)\n", directory, branch, remote_sha)
+                return True
         log.info(
             "Cleaning and updating %s to the latest branch %s from origin\n",
             directory,
             branch,
         )
-        _ = run_git_command(["clean", "-df"], directory=directory)
-        ok = run_git_command(["fetch", "origin"], directory=directory)
+        _ = run_git_command(["clean", "-df"], directory=directory, timeout=remaining())
+        ok = run_git_command(["fetch", "origin"], directory=directory, timeout=remaining())
         ok = ok and run_git_command(
-            ["reset", "--hard", "origin/%s" % (branch)], directory=directory
+            ["reset", "--hard", "origin/%s" % (branch)],
+            directory=directory,
+            timeout=remaining(),
         )
         return ok
 
@@ -118,13 +222,83 @@ def git_clone_or_pull(repo, directory, branch):
     return False
 
 
+def read_manifest(path):
+    """Read a manifest file of "REPO DIRECTORY [BRANCH]" lines; blank lines
+    and lines starting with "#" are ignored.
+
+    Returns:
+        list of (repo, directory, branch) tuples
+
+    """
+    entries = []
+    with open(path) as manifest:
+        for lineno, line in enumerate(manifest, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            if not 2 <= len(fields) <= 3:
+                raise ValueError(
+                    "%s:%d: expected REPO DIRECTORY [BRANCH]" % (path, lineno)
+                )
+            entries.append(tuple(fields) if len(fields) == 3 else tuple(fields) + ("master",))
+    return entries
+
+
+class _ThreadLogCapture(logging.Handler):
+    """Collect log records emitted by the current thread into a string, so
+    concurrent updates each get their own section in the notification.
+
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.thread = threading.get_ident()
+        self.stream = StringIO()
+
+    def emit(self, record):
+        if record.thread == self.thread:
+            self.stream.write(self.format(record) + "\n")
+
+
+def update_repos(entries, jobs, timeout=None, **kwargs):
+    """Run git_clone_or_pull() on each (repo, directory, branch) entry, up to
+    `jobs` at a time, each limited to `timeout` seconds.  Other keyword
+    arguments are passed on to git_clone_or_pull().
+
+    Returns:
+        list of (entry, ok, log output) tuples, in the order of `entries`
+
+    """
+
+    def update(entry):
+        capture = _ThreadLogCapture()
+        log.addHandler(capture)
+        try:
+            ok = git_clone_or_pull(*entry, timeout=timeout, **kwargs)
+        except Exception as e:
+            log.exception("Unhandled exception: %s", e)
+            ok = False
+        finally:
+            log.removeHandler(capture)
+        return entry, ok, capture.stream.getvalue()
+
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        return list(pool.map(update, entries))
+
+
 def main(argv):
     parser = ArgumentParser(description=__doc__)
     parser.add_argument(
-        "repo", metavar="URL", help="The URL of the Git repo to download from"
+        "repo",
+        metavar="URL",
+        nargs="?",
+        help="The URL of the Git repo to download from",
     )
     parser.add_argument(
-        "directory", metavar="DIRECTORY", help="The directory to download to"
+        "directory",
+        metavar="DIRECTORY",
+        nargs="?",
+        help="The directory to download to",
     )
     parser.add_argument(
         "branch",
@@ -133,6 +307,45 @@ def main(argv):
         default="master",
         help="The Git branch to use (default %(default)s)",
     )
+    parser.add_argument(
+        "--manifest",
+        metavar="PATH",
+        default=None,
+        help="Update all repos listed in this file instead of a single one",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        metavar="N",
+        type=int,
+        default=4,
+        help="Number of repos to update at once with --manifest (default %(default)s)",
+    )
+    parser.add_argument(
+        "--timeout",
+        metavar="SECONDS",
+        type=float,
+        default=None,
+        help="Give up on a repo if updating it takes longer than this",
+    )
+    parser.add_argument(
+        "--always-update",
+        action="store_true",
+        help="Clean, fetch and reset even if the branch is already up to date",
+    )
+    parser.add_argument(
+        "--depth",
+        metavar="N",
+        type=int,
+        default=None,
+        help="Make initial clones shallow, with only the last N commits",
+    )
+    parser.add_argument(
+        "--filter",
+        metavar="SPEC",
+        default=None,
+        help="Make initial clones partial, e.g. --filter=blob:none",
+    )
     parser.add_argument(
         "--verbose",
         "-v",
@@ -166,6 +379,11 @@ def main(argv):
         help="Subject to prefix notification email with; default: %(default)s",
     )
     args = parser.parse_args(argv[1:])
+    if args.manifest:
+        if args.repo:
+            parser.error("URL and DIRECTORY cannot be given with --manifest")
+    elif not args.directory:
+        parser.error("URL and DIRECTORY are required without --manifest")
 
     # Set up logging for email: log temporarily into a string and send it at the
     # end of the script.
@@ -186,8 +404,22 @@ def main(argv):
     loglevel = max(logging.DEBUG, logging.WARNING + 10 * (args.quiet - args.verbose))
     log.setLevel(loglevel)
 
+    clone_args = []
+    if args.depth:
+        # a shallow clone only gets the default branch unless told otherwise
+        clone_args += ["--depth", str(args.depth), "--no-single-branch"]
+    if args.filter:
+        clone_args += ["--filter", args.filter]
+    update_args = dict(clone_args=clone_args, always_update=args.always_update)
+
+    if args.manifest:
+        return update_manifest(args, logstream, update_args)
+
     try:
-        ret = 0 if git_clone_or_pull(args.repo, args.directory, args.branch) else 1
+        ok = git_clone_or_pull(
+            args.repo, args.directory, args.branch, args.timeout, **update_args
+        )
+        ret = 0 if ok else 1
     except Exception as e:
         log.exception("Unhandled exception: %s", e)
         ret = 99
@@ -204,6 +436,49 @@ def main(argv):
     return ret
 
 
+def update_manifest(args, logstream, update_args):
+    """Update all the repos in the manifest and send one notification, with
+    each repo's log output in its own section
+
+    """
+    try:
+        entries = read_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        log.error("Could not read manifest: %s", e)
+        if args.notify:
+            send_email(args.notify, "%s: FAIL" % args.subject, logstream.getvalue())
+        return 99
+
+    results = update_repos(entries, args.jobs, args.timeout, **update_args)
+    failed = [entry for entry, ok, _ in results if not ok]
+
+    summary = "%d of %d repos updated successfully\n" % (
+        len(results) - len(failed),
+        len(results),
+    )
+    for entry in failed:
+        summary += "FAILED: %s -> %s (%s)\n" % entry
+    sections = "".join(
+        "\n== %s -> %s (%s): %s ==\n%s" % (entry + ("ok" if ok else "FAIL", output))
+        for entry, ok, output in results
+        if output or not ok
+    )
+    text = summary + sections
+
+    if failed:
+        if args.notify:
+            send_email(
+                args.notify,
+                "%s: FAIL (%d of %d repos)" % (args.subject, len(failed), len(results)),
+                text,
+            )
+    elif args.notify_on_success:
+        if args.notify:
+            send_email(args.notify, "%s: ok" % args.subject, text)
+
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
     logging.basicConfig(format="%(message)s")
     sys.exit(main(sys.argv))